@@ -1,17 +1,34 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+from lxml import etree, html
+import diskcache
+import cachetools
+import orjson
 import folium
-from folium.plugins import MarkerCluster # Import MarkerCluster
+from folium.plugins import FastMarkerCluster
+from branca.element import MacroElement
+from jinja2 import Template
 import pandas as pd
-import random
+import numpy as np
+import colorsys
+import pickle
+import hashlib
+import zlib
+import importlib.util
 import time
 import sys
 import concurrent.futures
 import os
 from datetime import datetime
 import re
+import threading
+import queue
+import atexit
+import uuid
 
-from flask import Flask, render_template, request, flash, redirect, url_for, session
+from flask import Flask, render_template, request, flash, redirect, url_for, session, jsonify
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
@@ -22,31 +39,167 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 EXCEL_FILE_PATH = os.path.join(BASE_DIR, 'stations.xlsx')
 ETRAIN_INFO_BASE_URL_STATION = "https://etrain.info/station/{}/all"
 ETRAIN_INFO_BASE_URL_TRAIN = "https://etrain.info/train/{}/schedule"
-MAX_WORKERS = 25  # Keep lower for free tier memory constraints
+MAX_WORKERS = int(os.environ.get('FETCH_WORKERS', '25'))  # Keep lower for free tier memory constraints
 REQUEST_TIMEOUT = 25 # Slightly increased timeout
+CONNECT_TIMEOUT = 5  # A host that won't even accept the connection is not worth waiting REQUEST_TIMEOUT for
+FETCH_DEADLINE = 60  # Seconds a search waits for its route fetches; stragglers are dropped from the map
 PLOT_LIMIT = 300  # **** ADJUST THIS THRESHOLD AS NEEDED **** Max trains to process/plot
+MARKER_CLUSTER_THRESHOLD = 500  # Below this many stations, plain circle markers are lighter than clustering
+ROUTE_SIMPLIFY_TOLERANCE = 0.01  # Degrees (~1 km); route points closer than this to the drawn line are dropped
+MAP_THEMES = ('CartoDB positron', 'CartoDB dark_matter')  # The search form's choices; the first is the default
 HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    # Compressed HTML is a fraction of the bytes; urllib3 lists only the codings it can decode
+    # (gzip/deflate, plus br when Brotli is installed and zstd when a zstd module is available)
+    'Accept-Encoding': ACCEPT_ENCODING,
 }
+# Only these sheet columns are read (in the sheet's own order); NAME is optional, the rest are required
+STATION_COLUMNS = ['STN CODE', 'NAME', 'LAT', 'LON']
+# python-calamine (Rust) parses xlsx several times faster than openpyxl; use it when installed
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+MAX_RESPONSE_BYTES = 2 * 1024 * 1024  # Abandon pathological pages instead of risking OOM on the free tier
+# Compiled once and shared by all threads: the data-train attribute strings of the station page rows
+_DATA_TRAIN_XPATH = etree.XPath('//tr/@data-train', smart_strings=False)
+DEFAULT_PAGE_ENCODING = 'utf-8'  # What etrain.info serves; used when the response declares no charset
+_CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+# Matches the "num" field of a data-train attribute, e.g. {"num":"12345",...} or {'num': 12345, ...}
+_NUM_RE = re.compile(r'["\']num["\']\s*:\s*["\']?(\d+)')
+
+# Route line colors: the tab10 qualitative colors, extended to 32 with golden-ratio hue steps
+ROUTE_PALETTE = [f"#{c:06x}" for c in (0x1f77b4, 0xff7f0e, 0x2ca02c, 0xd62728, 0x9467bd,
+                                        0x8c564b, 0xe377c2, 0x7f7f7f, 0xbcbd22, 0x17becf)]
+ROUTE_PALETTE += [
+    "#{:02x}{:02x}{:02x}".format(*(int(v * 255) for v in colorsys.hsv_to_rgb((i * 0.618034) % 1, 0.8, 0.8)))
+    for i in range(32 - len(ROUTE_PALETTE))
+]
+
+# --- HTTP Session ---
+# One pooled session shared by all worker threads so connections to etrain.info are kept alive
+# and reused instead of paying a fresh TCP+TLS handshake per request.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS * 2,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+# Same pool for plain http, so any http:// links or redirects also get keep-alive and retries
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+# --- Fetch Executor ---
+# Created once per process and shared by every request, so each search reuses warm threads
+# (and their pooled SESSION connections) instead of spinning up and tearing down a pool.
+FETCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='fetch')
+# Schedule fetches in flight, so overlapping searches wait on one request per train instead of
+# each hitting etrain.info. The fetching thread owns the Future; the others just wait on it.
+train_fetches = {}  # train_number -> concurrent.futures.Future of (train_number, codes, info)
+train_fetches_lock = threading.Lock()
+
+# --- Background Jobs ---
+# Station searches run here rather than on the request thread, so the POST returns at once and
+# the page polls /status/<job_id>. Kept apart from FETCH_EXECUTOR because each job waits on fetches.
+# Job state and progress live in scrape_cache (see job_state_key), so any worker can answer the polls.
+JOB_WORKERS = 4
+JOB_TTL = 10 * 60  # seconds a job's state stays collectable after its last update
+JOB_PROGRESS_INTERVAL = 0.5  # seconds between progress writes to scrape_cache
+JOB_POLL_INTERVAL = 1  # seconds between checks when waiting on another worker's job
+JOB_STALL_TIMEOUT = FETCH_DEADLINE + 60  # A running job this long without an update is treated as lost (its worker died)
+JOB_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+jobs = {}  # job_id -> Future, for jobs running in this process
+jobs_lock = threading.Lock()
+
+# --- Feedback Writer ---
+# Submitted feedback is queued and appended to feedback.txt by one background thread, so a slow
+# disk never holds up the request; lines still queued at exit are flushed by an atexit hook.
+FEEDBACK_FILE = os.path.join(BASE_DIR, 'feedback.txt')
+feedback_queue = queue.Queue()
 
 # --- Caching ---
-station_coordinates_cache = None
+# Scraped station train lists and train schedules change rarely, so they are kept on disk
+# (shared by every worker process) and only re-fetched once they expire.
+CACHE_DIR = os.path.join(BASE_DIR, '.cache')
+STATION_CACHE_TTL = 24 * 60 * 60  # seconds; the trains calling at a station change more often
+TRAIN_CACHE_TTL = 7 * 24 * 60 * 60  # seconds; a train's schedule is only revised occasionally
+# A finished search (map id + table rows) per station and theme, in the same shared cache, so
+# any worker can answer a repeat search; it is only as fresh as the station's train list.
+# Past that it is kept a while longer as a stale copy: shown at once while a refresh runs.
+RESULTS_CACHE_TTL = STATION_CACHE_TTL
+RESULTS_STALE_TTL = TRAIN_CACHE_TTL
+CACHE_SIZE_LIMIT = 256 * 1024 * 1024  # bytes; diskcache evicts the oldest-stored entries beyond this
+scrape_cache = diskcache.Cache(CACHE_DIR, size_limit=CACHE_SIZE_LIMIT)
+
+# In-process front for the train schedule entries of scrape_cache, so a schedule this worker has
+# already seen (overlapping stations, repeat searches) skips the SQLite read and unpickle.
+# Kept well below the disk cache's lifetime and size: entries are shared, read-only objects.
+TRAIN_MEMORY_CACHE_SIZE = 2000
+TRAIN_MEMORY_CACHE_TTL = 60 * 60  # seconds
+train_memory_cache = cachetools.TTLCache(maxsize=TRAIN_MEMORY_CACHE_SIZE, ttl=TRAIN_MEMORY_CACHE_TTL)
+train_memory_cache_lock = threading.Lock()  # TTLCache is not thread-safe
+
+# Rendered maps are written to static/maps/ under a hash of station, theme and the exact routes
+# drawn, so the (up to megabyte) HTML never sits in the heap, every worker process can reuse a
+# map another one rendered, and a front proxy/CDN can serve the files without touching Python.
+MAP_DIR = os.path.join(BASE_DIR, 'static', 'maps')
+MAP_FILE_LIMIT = 64  # Oldest map files beyond this are deleted
+MAP_FILE_MAX_AGE = RESULTS_STALE_TTL  # seconds; no cached results point at older files
+MAP_JANITOR_INTERVAL = 60 * 60  # seconds between background prunes
+MAP_MAX_AGE = 60 * 60  # Browser cache lifetime (seconds); names are content hashes, so a file never changes
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = MAP_MAX_AGE  # The map files are the only static files
+os.makedirs(MAP_DIR, exist_ok=True)
+
+STATION_SNAPSHOT_VERSION = 3  # Bump when the pickled station data layout changes
+station_index_cache = None
 station_data_df_cache = None
-cached_map = None
+station_data_lock = threading.Lock()
+# Last map drawn by this process, for /switch_map_theme
+cached_map = None  # Map id (file name stem in MAP_DIR)
 cached_train_data = None
 cached_station_code = None
 
+# --- Cache Warmer ---
+# Searches are counted per (station, theme) in scrape_cache, off the request thread and with a
+# decay; a background thread keeps the most popular ones rebuilt ahead of expiry, so their
+# visitors never wait for a scrape.
+POPULAR_STATIONS_KEY = 'popular_stations'
+POPULAR_STATIONS_LIMIT = 200  # Distinct (station, theme) pairs kept; the least searched beyond this are dropped
+POPULAR_HALF_LIFE = 7 * 24 * 60 * 60  # seconds for a search's weight to halve, so old favourites fade out
+WARM_STATIONS_COUNT = 5
+station_search_queue = queue.Queue()
+WARMER_START_DELAY = 60  # seconds after startup, so booting and the first requests go first
+WARMER_INTERVAL = 60 * 60  # seconds between passes
+
 # --- Helper Functions ---
 
 def load_station_coordinates(file_path):
-    """Loads station coordinates, using cache if available."""
-    global station_coordinates_cache, station_data_df_cache
-    if station_coordinates_cache is not None and station_data_df_cache is not None:
-        return station_coordinates_cache, station_data_df_cache
+    """Loads station coordinates, using cache if available.
+
+    Coordinates are returned as a structure-of-arrays index ``(code_to_idx, lats, lons)``:
+    a dict mapping station code to a row number in two parallel float arrays.
+    """
+    global station_index_cache, station_data_df_cache
+    if station_index_cache is not None and station_data_df_cache is not None:
+        return station_index_cache, station_data_df_cache
+
+    # Only one thread parses the file; others that raced here wait and then reuse its result
+    with station_data_lock:
+        if station_index_cache is None or station_data_df_cache is None:
+            station_index, station_data = read_station_data(file_path)
+            if station_index is None:
+                return None, None
+            station_index_cache, station_data_df_cache = station_index, station_data
+        return station_index_cache, station_data_df_cache
+
+def read_station_data(file_path):
+    """Reads station data from the snapshot, or from the Excel file (refreshing the snapshot)."""
+    snapshot = load_station_snapshot(file_path)
+    if snapshot is not None:
+        return snapshot
 
     print(f"Loading station coordinates from: {file_path}")
     try:
-        station_data = pd.read_excel(file_path)
+        station_data = pd.read_excel(file_path, engine=EXCEL_ENGINE,
+                                     usecols=lambda col: str(col).strip().upper() in STATION_COLUMNS)
         station_data.columns = station_data.columns.str.strip().str.upper()
         required_cols = ['STN CODE', 'LAT', 'LON']
         if not all(col in station_data.columns for col in required_cols):
@@ -54,16 +207,20 @@ def load_station_coordinates(file_path):
             print(f"Error: Missing required columns in {file_path}: {missing}")
             return None, None
 
-        station_data['LAT'] = pd.to_numeric(station_data['LAT'], errors='coerce')
-        station_data['LON'] = pd.to_numeric(station_data['LON'], errors='coerce')
+        # Clean sheets come back as float columns already; only coerce when stray text cells are present
+        for col in ('LAT', 'LON'):
+            if not pd.api.types.is_float_dtype(station_data[col]):
+                station_data[col] = pd.to_numeric(station_data[col], errors='coerce')
         station_data.dropna(subset=['LAT', 'LON'], inplace=True)
 
-        coordinates = dict(zip(station_data['STN CODE'], zip(station_data['LAT'], station_data['LON'])))
-        print(f"Successfully loaded coordinates for {len(coordinates)} stations.")
+        code_to_idx = {code: i for i, code in enumerate(station_data['STN CODE'])}
+        lats = station_data['LAT'].to_numpy(dtype=np.float64)
+        lons = station_data['LON'].to_numpy(dtype=np.float64)
+        station_index = (code_to_idx, lats, lons)
+        print(f"Successfully loaded coordinates for {len(code_to_idx)} stations.")
 
-        station_coordinates_cache = coordinates
-        station_data_df_cache = station_data
-        return coordinates, station_data
+        save_station_snapshot(file_path, (station_index, station_data))
+        return station_index, station_data
     except FileNotFoundError:
         print(f"Error: The file '{file_path}' was not found.")
         return None, None
@@ -71,87 +228,430 @@ def load_station_coordinates(file_path):
         print(f"An unexpected error occurred while reading {file_path}: {e}")
         return None, None
 
-def clear_cache():
-    """Clears the cached map and train data."""
-    global cached_map, cached_train_data, cached_station_code
-    cached_map = None
-    cached_train_data = None
-    cached_station_code = None
+def load_station_snapshot(file_path):
+    """Loads the pickled (station_index, station_data) snapshot if it is newer than the Excel file."""
+    snapshot_path = file_path + '.pkl'
+    try:
+        if os.path.getmtime(snapshot_path) < os.path.getmtime(file_path):
+            return None  # Excel file was updated since the snapshot was written
+        with open(snapshot_path, 'rb') as f:
+            version, station_index, station_data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Warning: Could not read station snapshot {snapshot_path}: {e}")
+        return None
+    if version != STATION_SNAPSHOT_VERSION:
+        return None  # Written by an older layout of load_station_coordinates
+    print(f"Loaded coordinates for {len(station_index[0])} stations from snapshot: {snapshot_path}")
+    return station_index, station_data
+
+def save_station_snapshot(file_path, snapshot):
+    """Pickles the parsed station data next to the Excel file so later boots skip read_excel."""
+    snapshot_path = file_path + '.pkl'
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((STATION_SNAPSHOT_VERSION, *snapshot), f, protocol=5)
+        os.replace(tmp_path, snapshot_path)  # Atomic, so other workers never see a partial file
+    except Exception as e:
+        print(f"Warning: Could not write station snapshot {snapshot_path}: {e}")
+
+def map_cache_key(station_code, theme, train_station_routes):
+    """Builds the map id (a stable hash, the same in every process) for a station/theme and the routes drawn."""
+    routes_sig = sorted((num, tuple(route)) for num, route in train_station_routes.items())
+    return hashlib.sha1(repr((station_code, theme, routes_sig)).encode()).hexdigest()[:20]
+
+def map_file_path(map_id):
+    """Returns the path of the rendered map file for a map id."""
+    return os.path.join(MAP_DIR, f"{map_id}.html")
+
+def save_map_file(map_id, folium_map):
+    """Renders the standalone map document to its file in MAP_DIR, then prunes the oldest map files."""
+    path = map_file_path(map_id)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(folium_map.get_root().render())
+    os.replace(tmp_path, path)  # Atomic, so a concurrent request never serves a half-written map
+    prune_map_files()
+
+def remove_map_file(path):
+    """Deletes a map file; one another worker's janitor already removed is fine."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def prune_map_files():
+    """Deletes map files older than MAP_FILE_MAX_AGE (and stray temp files), then all but the newest MAP_FILE_LIMIT."""
+    now = time.time()
+    try:
+        map_files = []
+        for entry in os.scandir(MAP_DIR):
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue  # Already removed by another worker's janitor, or renamed into place
+            if entry.name.endswith('.tmp'):
+                if now - mtime > MAP_JANITOR_INTERVAL:
+                    remove_map_file(entry.path)  # Left behind by a worker that died mid-write
+            elif entry.name.endswith('.html'):
+                if now - mtime > MAP_FILE_MAX_AGE:
+                    remove_map_file(entry.path)
+                else:
+                    map_files.append((mtime, entry.path))
+        if len(map_files) > MAP_FILE_LIMIT:
+            map_files.sort()
+            for _, path in map_files[:-MAP_FILE_LIMIT]:
+                remove_map_file(path)
+    except OSError as e:
+        print(f"Warning: Could not prune map files in {MAP_DIR}: {e}")
+
+def map_janitor():
+    while True:
+        time.sleep(MAP_JANITOR_INTERVAL)
+        prune_map_files()
+
+def get_station_name(station_code, station_index, station_data_df):
+    """Returns the station's name from station_data_df, or None for an unknown code.
+
+    The row comes from the code -> row index rather than scanning the code column.
+    """
+    station_row_idx = station_index[0].get(station_code)
+    if station_row_idx is None:
+        return None
+    if 'NAME' not in station_data_df.columns:
+        return None
+    return station_data_df['NAME'].iat[station_row_idx]
+
+def results_cache_key(station_code, theme):
+    """Returns the scrape_cache key of a finished search's results."""
+    return f"results:{station_code}:{theme}"
+
+def job_state_key(job_id):
+    """Returns the scrape_cache key of a background job's shared state."""
+    return f"job:{job_id}"
+
+def running_job_key(station_code, theme):
+    """Returns the scrape_cache key holding the id of the job currently searching a station."""
+    return f"running_job:{station_code}:{theme}"
+
+_parser_encodings = {}  # Declared charset -> whether lxml's parsers accept it
+
+def response_encoding(response):
+    """Returns the charset declared in the response's Content-Type, else DEFAULT_PAGE_ENCODING.
+
+    Handing this to the lxml parser up front skips its meta-tag/byte sniffing of every page.
+    requests' own response.encoding is not used: it falls back to ISO-8859-1 for any text/* type.
+    A charset lxml doesn't know (it raises LookupError on those) also falls back to the default.
+    """
+    charset_match = _CHARSET_RE.search(response.headers.get('Content-Type', ''))
+    if not charset_match:
+        return DEFAULT_PAGE_ENCODING
+    encoding = charset_match.group(1).lower()
+    if encoding not in _parser_encodings:
+        try:
+            html.HTMLParser(encoding=encoding)
+            _parser_encodings[encoding] = True
+        except LookupError:
+            print(f"Warning: Unknown charset {encoding!r} in response; parsing as {DEFAULT_PAGE_ENCODING}.")
+            _parser_encodings[encoding] = False
+    return encoding if _parser_encodings[encoding] else DEFAULT_PAGE_ENCODING
+
+class ResponseTooLarge(Exception):
+    """Raised while streaming a response body that grows past MAX_RESPONSE_BYTES."""
+
+def iter_response_chunks(response):
+    """Yields a streamed response body in 64 KB chunks, raising ResponseTooLarge past MAX_RESPONSE_BYTES.
+
+    Chunks go straight to an lxml feed parser, so the body is never joined into one bytes object.
+    """
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        size += len(chunk)
+        if size > MAX_RESPONSE_BYTES:
+            raise ResponseTooLarge(size)
+        yield chunk
+
+def drain_response(response, chunks=None):
+    """Reads and discards the rest of a streamed response, so its connection goes back to the pool.
+
+    chunks continues an iter_response_chunks() already under way; the MAX_RESPONSE_BYTES cap
+    still applies, and a body past it is not worth reading, so the connection is dropped instead.
+    """
+    try:
+        for _ in chunks if chunks is not None else iter_response_chunks(response):
+            pass
+    except ResponseTooLarge:
+        response.close()
 
 def get_trains_for_station(station_code):
+    """Returns train numbers for a given station, using the disk cache if available."""
+    cache_key = f"station:{station_code.upper()}"
+    train_numbers = scrape_cache.get(cache_key)
+    if train_numbers is not None:
+        return train_numbers
+
+    train_numbers = fetch_trains_for_station(station_code)
+    if train_numbers:  # Don't cache fetch errors or empty pages
+        scrape_cache.set(cache_key, train_numbers, expire=STATION_CACHE_TTL)
+    return train_numbers
+
+def fetch_trains_for_station(station_code):
     """Fetches train numbers for a given station."""
     url = ETRAIN_INFO_BASE_URL_STATION.format(station_code.upper())
     try:
-        response = requests.get(url, timeout=REQUEST_TIMEOUT, headers=HEADERS)
-        response.raise_for_status()
+        with SESSION.get(url, timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT), stream=True) as response:
+            if not response.ok:
+                drain_response(response)  # Error pages are read to the end too, so the connection is reused
+                response.raise_for_status()
+            parser = html.HTMLParser(encoding=response_encoding(response))
+            for chunk in iter_response_chunks(response):
+                parser.feed(chunk)
     except requests.exceptions.RequestException as e:
         print(f"Error fetching train list for station {station_code}: {e}")
         return None
+    except ResponseTooLarge:
+        print(f"Error: Train list page for station {station_code} is larger than {MAX_RESPONSE_BYTES} bytes.")
+        return None
 
-    soup = BeautifulSoup(response.content, 'html.parser')
+    # An empty body gives no document: close() returns None, or raises if nothing was ever fed
+    try:
+        tree = parser.close()
+    except etree.XMLSyntaxError:
+        tree = None
+    if tree is None:
+        print(f"Empty train list page for station {station_code}.")
+        return []
     train_numbers = []
-    rows = soup.find_all("tr", {"data-train": True})
+    train_data_strs = _DATA_TRAIN_XPATH(tree)
 
-    if not rows:
+    if not train_data_strs:
         print(f"No train data found on page for station {station_code}.")
         return []
 
-    for row in rows:
-        train_data_str = row.get("data-train")
+    for train_data_str in train_data_strs:
         if train_data_str:
-            try:
-                train_info = eval(train_data_str) # Use with caution
-                if isinstance(train_info, dict) and "num" in train_info:
-                    train_numbers.append(str(train_info["num"]))
-            except Exception as e:
-                print(f"Warning: Could not evaluate data-train attribute: {train_data_str}. Error: {e}")
+            num_match = _NUM_RE.search(train_data_str)
+            if num_match:
+                train_numbers.append(num_match.group(1))
+            else:
+                print(f"Warning: No train number in data-train attribute: {train_data_str}")
     return train_numbers
 
-def extract_train_info_from_soup(soup):
-    """Extracts train number, name, starting and terminating stations from soup."""
+# Schedule page <title> patterns, e.g. "Train Schedule of SARAIGHAT EXPRESS (12345) with Availability..."
+_TITLE_NUM_RE = re.compile(r'\((\d+)\)')
+_TITLE_NAME_RE = re.compile(r'Train Schedule of (.*?) \(')
+
+def extract_train_info(title_text, h1_text, mdtext_text):
+    """Extracts train number, name, starting and terminating stations from schedule page text."""
     train_info = {}
 
     # Extract Train Number and Name from <title> or <h1>
-    title_tag = soup.find('title')
-    if title_tag:
-        title_text = title_tag.text
+    if title_text:
         # Example: "Train Schedule of SARAIGHAT EXPRESS (12345) with Availability..."
-        num_match = re.search(r'\((\d+)\)', title_text)
-        name_match = re.search(r'Train Schedule of (.*?) \(', title_text)
+        num_match = _TITLE_NUM_RE.search(title_text)
+        name_match = _TITLE_NAME_RE.search(title_text)
         if num_match:
             train_info['number'] = num_match.group(1)
         if name_match:
             train_info['name'] = name_match.group(1).strip()
-    if not train_info.get('name'):
-        h1 = soup.find('h1')
-        if h1:
-            train_info['name'] = h1.get_text(strip=True)
+    if not train_info.get('name') and h1_text is not None:
+        train_info['name'] = h1_text
 
     # Extract Starting and Terminating Station from span.mdtext or similar
-    mdtext_span = soup.find('span', class_='mdtext')
-    if mdtext_span:
-        station_text = mdtext_span.text.strip()
+    if mdtext_text:
         # Example: "HOWRAH JN to GUWAHATI"
-        if 'to' in station_text:
-            parts = station_text.split('to')
+        if 'to' in mdtext_text:
+            parts = mdtext_text.split('to')
             train_info['start_name'] = parts[0].strip()
             train_info['end_name'] = parts[1].strip()
 
     return train_info
 
-def get_station_codes_for_train(train_number):
-    """Fetches station codes and train info for a single train."""
+def _text(elem):
+    """Returns all text inside an element, like lxml.html's text_content()."""
+    return ''.join(elem.itertext())
+
+def _class_token_re(class_name):
+    """Compiles a pattern matching class_name as a whole token of a class attribute."""
+    return re.compile(r'(?:^|\s)' + re.escape(class_name) + r'(?:\s|$)')
+
+# Compiled once at import so the parser's per-element class tests don't split class strings
+_SCHTBL_CLASS = _class_token_re('schtbl')
+_STNC_CLASS = _class_token_re('stnc')
+_MDTEXT_CLASS = _class_token_re('mdtext')
+
+def _has_class(elem, class_re):
+    """Checks whether the element's class attribute contains the class matched by class_re."""
+    return class_re.search(elem.get('class') or '') is not None
+
+def _enclosing_schedule_table(link):
+    """Returns the table.schtbl a link sits in via a td.stnc cell, or None."""
+    in_station_cell = False
+    node = link.getparent()
+    while node is not None:
+        if node.tag == 'td' and _has_class(node, _STNC_CLASS):
+            in_station_cell = True
+        elif node.tag == 'table' and _has_class(node, _SCHTBL_CLASS):
+            return node if in_station_cell else None
+        node = node.getparent()
+    return None
+
+def _in_source_select(option):
+    """Checks whether an <option> belongs to the select[name=src] station picker."""
+    node = option.getparent()
+    while node is not None:
+        if node.tag == 'select':
+            return node.get('name') == 'src'
+        node = node.getparent()
+    return False
+
+# Tags this parser reads text from, plus bulky containers that are dropped once fully parsed
+_SCHEDULE_TAGS = ('title', 'h1', 'span', 'a', 'option')
+_PRUNE_TAGS = ('tr', 'table', 'select', 'div', 'script', 'style', 'ul')
+
+def _iter_parse_events(chunks, tags, encoding):
+    """Feeds byte chunks to an HTML pull parser, yielding (event, element) pairs as soon as they parse."""
+    parser = etree.HTMLPullParser(events=('end',), tag=tags, encoding=encoding)
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+def parse_schedule_page(chunks, encoding=DEFAULT_PAGE_ENCODING):
+    """Stream-parses a train schedule page, given as an iterable of byte chunks in the given
+    encoding, into (station_codes, station_names, train_info).
+
+    Only the elements needed are inspected; everything else (ads, footer, sidebars) is
+    cleared as soon as it has been parsed so the full document tree is never held in memory.
+    Parsing stops once the schedule table and the header text have all been seen.
+    """
+    title_text = h1_text = mdtext_text = None
+    schedule_table = None
+    schedule_done = False
+    station_codes, station_names = [], []
+    option_codes, option_names = [], []
+
+    for _, elem in _iter_parse_events(chunks, _SCHEDULE_TAGS + _PRUNE_TAGS, encoding):
+        tag = elem.tag
+        if tag == 'title':
+            if title_text is None:
+                title_text = _text(elem)
+        elif tag == 'h1':
+            if h1_text is None:
+                h1_text = _text(elem).strip()
+        elif tag == 'span':
+            if mdtext_text is None and _has_class(elem, _MDTEXT_CLASS):
+                mdtext_text = _text(elem).strip()
+        elif tag == 'a':
+            if '/station/' in (elem.get('href') or ''):
+                table = _enclosing_schedule_table(elem)
+                # Like the original lookup, only the first schedule table on the page is used
+                if table is not None and (schedule_table is None or table is schedule_table):
+                    schedule_table = table
+                    link_text = _text(elem).strip()
+                    code_part = link_text.split('-')[0].strip()
+                    name_part = '-'.join(link_text.split('-')[1:]).strip() if '-' in link_text else ''
+                    if code_part:
+                        station_codes.append(code_part)
+                        station_names.append(name_part)
+        elif tag == 'option':
+            if elem.get('value') and _in_source_select(elem):
+                option_codes.append(elem.get('value'))
+                option_names.append(_text(elem).strip())
+        elif tag == 'table':
+            if schedule_table is None and _has_class(elem, _SCHTBL_CLASS):
+                schedule_table = elem
+            if elem is schedule_table:
+                schedule_done = True
+
+        if tag in _PRUNE_TAGS:
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+        # Once the schedule table has closed and the header text is in, nothing later on the page
+        # is used, so the rest (footer, ads) is not parsed
+        if schedule_done and None not in (title_text, h1_text, mdtext_text):
+            break
+
+    if schedule_table is None:
+        # No schedule table: fall back to the source-station <select>
+        station_codes, station_names = option_codes, option_names
+
+    return station_codes, station_names, extract_train_info(title_text, h1_text, mdtext_text)
+
+def get_station_codes_for_train(train_number, cancel_event=None):
+    """Returns station codes and train info for a single train, using the memory or disk cache if available.
+
+    If cancel_event is set by the time the network would be hit, the fetch is skipped. If another
+    thread is already fetching this train, its result is shared instead of fetching it again.
+    """
+    cache_key = f"train:{train_number}"
+    with train_memory_cache_lock:
+        cached = train_memory_cache.get(cache_key)
+    if cached is None:
+        cached = scrape_cache.get(cache_key)
+        if cached is not None:
+            with train_memory_cache_lock:
+                train_memory_cache[cache_key] = cached
+    if cached is not None:
+        station_codes, train_info = cached
+        return train_number, station_codes, train_info
+    if cancel_event is not None and cancel_event.is_set():
+        return train_number, None, None
+
+    with train_fetches_lock:
+        pending = train_fetches.get(train_number)
+        is_owner = pending is None
+        if is_owner:
+            pending = train_fetches[train_number] = concurrent.futures.Future()
+    if not is_owner:
+        return pending.result()
+
     try:
-        formatted_train_number = f"{int(train_number):05d}"
-    except ValueError:
+        result = fetch_station_codes_for_train(train_number)
+        train_number, station_codes, train_info = result
+        if station_codes:  # Don't cache fetch/parse errors
+            scrape_cache.set(cache_key, (station_codes, train_info), expire=TRAIN_CACHE_TTL)
+            with train_memory_cache_lock:
+                train_memory_cache[cache_key] = (station_codes, train_info)
+        pending.set_result(result)
+        return result
+    except BaseException as e:
+        pending.set_exception(e)
+        raise
+    finally:
+        # Cached before this is dropped, so a later caller finds the result in train_memory_cache
+        with train_fetches_lock:
+            train_fetches.pop(train_number, None)
+
+def fetch_station_codes_for_train(train_number):
+    """Fetches station codes and train info for a single train."""
+    # Numbers are scraped as digit strings, so they are padded as-is instead of round-tripping through int
+    if not train_number.isdecimal():
         return train_number, None, None
+    formatted_train_number = train_number.zfill(5)
 
     url = ETRAIN_INFO_BASE_URL_TRAIN.format(formatted_train_number)
     try:
-        response = requests.get(url, timeout=REQUEST_TIMEOUT, headers=HEADERS)
-        if response.status_code == 404:
-            return train_number, None, None
-        response.raise_for_status()
+        with SESSION.get(url, timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT), stream=True) as response:
+            if not response.ok:
+                drain_response(response)  # Error pages are read to the end too, so the connection is reused
+                if response.status_code == 404:
+                    return train_number, None, None
+                response.raise_for_status()
+            # The page is parsed while it downloads, chunk by chunk
+            chunks = iter_response_chunks(response)
+            station_codes, station_names, train_info = parse_schedule_page(chunks, response_encoding(response))
+            # Parsing may stop early; the unparsed tail is still read (an oversized one is dropped
+            # without losing the schedule already parsed)
+            drain_response(response, chunks)
+    except ResponseTooLarge:
+        print(f"Error: Schedule page for train {formatted_train_number} is larger than {MAX_RESPONSE_BYTES} bytes.")
+        return train_number, None, None
     except requests.exceptions.RequestException as e:
         print(f"Error fetching schedule for train {formatted_train_number}: {e}")
         return train_number, None, None
@@ -159,62 +659,96 @@ def get_station_codes_for_train(train_number):
         print(f"Unexpected error processing train {formatted_train_number}: {e}")
         return train_number, None, None
 
-    try:
-        soup = BeautifulSoup(response.content, 'html.parser')
-        train_info = extract_train_info_from_soup(soup)
-        # Get schedule table
-        schedule_table = soup.find('table', class_=lambda x: x and 'schtbl' in x.split())
-        station_codes = []
-        station_names = []
-        if schedule_table:
-            rows = schedule_table.find_all('tr')
-            for row in rows:
-                station_cell = row.find('td', class_=lambda x: x and 'stnc' in x.split())
-                if station_cell:
-                    link = station_cell.find('a', href=lambda x: x and '/station/' in x)
-                    if link:
-                        link_text = link.get_text(strip=True)
-                        code_part = link_text.split('-')[0].strip()
-                        name_part = '-'.join(link_text.split('-')[1:]).strip() if '-' in link_text else ''
-                        if code_part:
-                            station_codes.append(code_part)
-                            station_names.append(name_part)
-        elif soup.find('select', {'name': 'src'}):
-            source_select = soup.find('select', {'name': 'src'})
-            options = source_select.find_all('option')
-            if options:
-                station_codes = [opt['value'] for opt in options if opt.has_attr('value') and opt['value']]
-                station_names = [opt.get_text(strip=True) for opt in options if opt.has_attr('value') and opt['value']]
-
-        # Prepare info for table
-        if station_codes:
-            train_info['start_code'] = station_codes[0]
-            train_info['end_code'] = station_codes[-1]
-            if station_names:
-                train_info['start_name'] = station_names[0]
-                train_info['end_name'] = station_names[-1]
-        else:
-            train_info['start_code'] = train_info['end_code'] = ''
-            if 'start_name' not in train_info:
-                train_info['start_name'] = ''
-            if 'end_name' not in train_info:
-                train_info['end_name'] = ''
-
-        return train_number, station_codes if station_codes else None, train_info
-    except Exception as e:
-        print(f"Error parsing HTML for train {formatted_train_number}: {e}")
-        return train_number, None, None
-
-def generate_map(station_code, station_coordinates, station_data_df, train_station_routes, theme='CartoDB positron'):
-    """Generates the Folium map object using MarkerCluster."""
+    # Prepare info for table
+    if station_codes:
+        train_info['start_code'] = station_codes[0]
+        train_info['end_code'] = station_codes[-1]
+        if station_names:
+            train_info['start_name'] = station_names[0]
+            train_info['end_name'] = station_names[-1]
+    else:
+        train_info['start_code'] = train_info['end_code'] = ''
+        if 'start_name' not in train_info:
+            train_info['start_name'] = ''
+        if 'end_name' not in train_info:
+            train_info['end_name'] = ''
+
+    return train_number, station_codes if station_codes else None, train_info
+
+def route_color(train_number):
+    """Picks a train's line color from ROUTE_PALETTE by its number, so it is the same on every map.
+
+    Numbers are halved first: up/down pairs (12301/12302) share a color, and since the reverse
+    filter mostly keeps odd numbers, consecutive kept trains still land on different colors.
+    """
+    key = (int(train_number) + 1) // 2 if train_number.isdecimal() else zlib.crc32(train_number.encode())
+    return ROUTE_PALETTE[key % len(ROUTE_PALETTE)]
+
+class RouteLines(MacroElement):
+    """All route polylines as one JSON array, turned into Leaflet polylines by a single JS loop.
+
+    Each entry is ``{"c": [[[lat, lon], ...], ...], "col": color, "t": train_number}``; ``c`` holds
+    one coordinate list per unbroken segment, which L.polyline draws as a single multi-polyline.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this.data_json }}.forEach(function (r) {
+                L.polyline(r.c, {color: r.col, weight: 2, opacity: 0.7})
+                    .bindTooltip('Train: ' + r.t)
+                    .addTo({{ this._parent.get_name() }});
+            });
+        {% endmacro %}
+    """)
+
+    def __init__(self, data):
+        super().__init__()
+        self._name = 'RouteLines'
+        # Serialised once with orjson (much faster than the stdlib json behind |tojson on big
+        # coordinate arrays); '<' is escaped so the inline <script> can never be closed early
+        self.data_json = orjson.dumps(data).decode().replace('<', '\\u003c')
+
+def simplify_line(points, tolerance=ROUTE_SIMPLIFY_TOLERANCE):
+    """Simplifies an (n, 2) array of points with Ramer-Douglas-Peucker, keeping both endpoints.
+
+    Every input point stays within tolerance of the returned polyline. Each span's distances are
+    computed in one NumPy pass; spans are split iteratively, not recursively.
+    """
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, len(points) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+        offsets = points[start + 1:end] - points[start]
+        direction = points[end] - points[start]
+        length_sq = direction @ direction
+        # Distance to the nearest point on the span's segment, not the infinite line through it,
+        # so stops past either end (a route doubling back) are kept. A zero-length span is a loop.
+        t = np.clip(offsets @ direction / length_sq, 0.0, 1.0) if length_sq else np.zeros(len(offsets))
+        gaps = offsets - t[:, None] * direction
+        distances = np.hypot(gaps[:, 0], gaps[:, 1])
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            spans.append((start, split))
+            spans.append((split, end))
+    return points[keep]
+
+def generate_map(station_code, station_index, station_data_df, train_station_routes, theme='CartoDB positron'):
+    """Generates the Folium map object with the route polylines and station markers."""
     print(f"Generating map for {len(train_station_routes)} unique direction routes with theme '{theme}'...")
-    if not station_coordinates or station_data_df is None or station_data_df.empty:
+    code_to_idx, lats, lons = station_index if station_index is not None else ({}, None, None)
+    if not code_to_idx or station_data_df is None or station_data_df.empty:
         map_center = [20.5937, 78.9629]  # India center
         zoom_level = 5
     else:
-        target_coords = station_coordinates.get(station_code)
-        if target_coords:
-            map_center = target_coords
+        target_idx = code_to_idx.get(station_code)
+        if target_idx is not None:
+            map_center = [float(lats[target_idx]), float(lons[target_idx])]
             zoom_level = 8
         else:
             map_center = [station_data_df['LAT'].mean(), station_data_df['LON'].mean()]
@@ -222,53 +756,447 @@ def generate_map(station_code, station_coordinates, station_data_df, train_stati
 
     train_map = folium.Map(location=map_center, zoom_start=zoom_level, tiles=theme)
 
-    # Create a MarkerCluster layer
-    marker_cluster = MarkerCluster(name="Train Stations").add_to(train_map)
-
-    added_station_markers = set()  # Still useful to avoid duplicate marker objects
-
-    for train_number, stations in train_station_routes.items():
-        route_points = []
-        color = "#{:06x}".format(random.randint(0, 0xFFFFFF))
-
-        for stn_code in stations:
-            coords = station_coordinates.get(stn_code)
-            if coords:
-                route_points.append(coords)
-                if stn_code not in added_station_markers:
-                    folium.Marker(
-                        location=coords,
-                        popup=f"{stn_code}", tooltip=f"Station: {stn_code}",
-                        icon=folium.Icon(color='darkblue', icon='info-sign')
-                    ).add_to(marker_cluster)
-                    added_station_markers.add(stn_code)
-            else:
-                if len(route_points) > 1:
-                    folium.PolyLine(route_points, color=color, weight=2, opacity=0.7,
-                                    tooltip=f"Train: {train_number}").add_to(train_map)
-                route_points = []
+    routes = list(train_station_routes.items())
+    # Resolve the stops of every route in one gather: row index per stop, -1 where coordinates are unknown
+    all_codes = [stn_code for _, stations in routes for stn_code in stations]
+    all_idx = np.fromiter((code_to_idx.get(c, -1) for c in all_codes), dtype=np.intp, count=len(all_codes))
+
+    station_rows = {}  # Unique stations with coordinates -> row index, in first-seen order
+    for stn_code, i in zip(all_codes, all_idx.tolist()):
+        if i >= 0:
+            station_rows.setdefault(stn_code, i)
+
+    latlon = np.column_stack((lats, lons)) if station_rows else None
+    route_lines = []  # One compact entry per train, drawn client-side by a single RouteLines element
+    route_ends = np.cumsum([len(stations) for _, stations in routes], dtype=np.intp)
+
+    for (train_number, _), route_idx in zip(routes, np.split(all_idx, route_ends[:-1])):
+        color = route_color(train_number)
 
-        if len(route_points) > 1:
-            folium.PolyLine(route_points, color=color, weight=2, opacity=0.7,
-                            tooltip=f"Train: {train_number}").add_to(train_map)
+        # A station without coordinates breaks the line; draw each run of known stations separately
+        segments = []
+        for segment in np.split(route_idx, np.flatnonzero(route_idx < 0)):
+            segment = segment[segment >= 0]
+            if len(segment) > 1:
+                segments.append(simplify_line(latlon[segment]).tolist())
+        if segments:
+            route_lines.append({"c": segments, "col": color, "t": train_number})
 
+    if route_lines:
+        RouteLines(route_lines).add_to(train_map)
+
+    add_station_markers(train_map, station_rows, lats, lons)
     return train_map
 
+# Same marker as folium.Icon(color='darkblue', icon='info-sign'), with the code as popup and tooltip
+STATION_MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: 'info-sign', markerColor: 'darkblue', prefix: 'glyphicon'});
+    return L.marker(new L.LatLng(row[0], row[1]), {icon: icon})
+        .bindPopup(row[2])
+        .bindTooltip('Station: ' + row[2]);
+}
+"""
+
+def add_station_markers(train_map, station_rows, lats, lons):
+    """Adds one marker per station: light circle markers normally, clustered icons for very busy maps."""
+    if not station_rows:
+        return  # An empty GeoJson layer would fail to render its tooltip fields
+    if len(station_rows) < MARKER_CLUSTER_THRESHOLD:
+        # All stations as one GeoJSON layer of circle markers: a single JSON blob, no per-marker objects
+        station_features = [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [float(lons[i]), float(lats[i])]},
+                "properties": {"code": stn_code},
+            }
+            for stn_code, i in station_rows.items()
+        ]
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": station_features},
+            name="Train Stations",
+            marker=folium.CircleMarker(radius=4, color='darkblue', fill=True, fill_opacity=0.8),
+            tooltip=folium.GeoJsonTooltip(fields=["code"], aliases=["Station:"]),
+            popup=folium.GeoJsonPopup(fields=["code"], labels=False),
+        ).add_to(train_map)
+    else:
+        # Too many markers to draw individually; let Leaflet cluster them. The stations go in as one
+        # [lat, lon, code] array and the markers are built in the browser by STATION_MARKER_CALLBACK.
+        FastMarkerCluster(
+            [[float(lats[i]), float(lons[i]), stn_code] for stn_code, i in station_rows.items()],
+            callback=STATION_MARKER_CALLBACK,
+            name="Train Stations",
+        ).add_to(train_map)
+
+def build_station_results(searched_station, station_name, map_theme, station_index, station_data_df,
+                          report_progress=None):
+    """Runs the full search for a station: train list, route fetches, reverse filtering and the map.
+
+    Returns the template context for the results page. If report_progress is given, it is called
+    with (processed, total) as the routes are fetched.
+    """
+    global cached_map, cached_train_data, cached_station_code
+
+    station_display = f"{searched_station}: {station_name}" if station_name else searched_station
+    print(f"Request received for station: {searched_station}")
+
+    # 1. Fetch Train Numbers
+    train_numbers = get_trains_for_station(searched_station)
+
+    if train_numbers is None:
+        error_message = f"Error fetching train list for {searched_station}. Website might be down or unreachable."
+        return {'error_message': error_message, 'searched_station': searched_station}
+    elif not train_numbers:
+        status_message = f"No trains found passing through {station_display} according to etrain.info."
+        return {'status_message': status_message, 'searched_station': searched_station}
+
+    total_trains_found = len(train_numbers)
+
+    # --- Apply Plot Limit ---
+    trains_to_process_list = train_numbers
+    limit_applied = False
+    if total_trains_found > PLOT_LIMIT:
+        print(f"Limiting processing to {PLOT_LIMIT} out of {total_trains_found} trains found.")
+        trains_to_process_list = train_numbers[:PLOT_LIMIT]
+        limit_applied = True
+    total_trains_to_process = len(trains_to_process_list)
+    if report_progress is not None:
+        report_progress(0, total_trains_to_process)
+
+    print(f"Processing {total_trains_to_process} trains (out of {total_trains_found} found)...")
+
+    # 2. Fetch Routes Concurrently
+    all_fetched_routes = {}
+    all_train_infos = {}
+    futures_map = {}
+    processed_count = 0
+
+    cancel_event = threading.Event()  # Lets queued fetches bail out if this search dies early
+    for train_num in trains_to_process_list:
+        future = FETCH_EXECUTOR.submit(get_station_codes_for_train, train_num, cancel_event)
+        futures_map[future] = train_num
+
+    timed_out_count = 0
+    try:
+        for future in concurrent.futures.as_completed(futures_map, timeout=FETCH_DEADLINE):
+            original_train_num = futures_map[future]
+            processed_count += 1
+            try:
+                returned_train_num, station_codes, train_info = future.result()
+                if station_codes and len(station_codes) >= 2:
+                    all_fetched_routes[returned_train_num] = station_codes
+                    if train_info:
+                        all_train_infos[returned_train_num] = train_info
+            except Exception as exc:
+                print(f"Train {original_train_num} generated an exception during fetch/process: {exc}")
+
+            if report_progress is not None:
+                report_progress(processed_count, total_trains_to_process)
+            if processed_count % 20 == 0 or processed_count == total_trains_to_process:
+                print(f"    Route fetching progress: {processed_count}/{total_trains_to_process}")
+    except concurrent.futures.TimeoutError:
+        # A few stalled pages shouldn't hold up the whole map; draw what has arrived
+        timed_out_count = total_trains_to_process - processed_count
+        print(f"Fetch deadline of {FETCH_DEADLINE}s reached; skipping {timed_out_count} unfinished trains.")
+    finally:
+        # Normally a no-op; if the search errored, stop work still queued on the shared
+        # executor instead of letting it burn etrain.info requests for nobody
+        cancel_event.set()
+        for future in futures_map:
+            future.cancel()
+
+    fetched_route_count = len(all_fetched_routes)
+    print(f"Fetched {fetched_route_count} valid routes. Filtering reverse duplicates...")
+
+    # 2.5 Filter Reverse Duplicates
+    train_station_routes_final = {} # Holds final routes to plot
+    unpaired_by_endpoints = {} # (start, end) -> kept trains still waiting for their reverse mate
+
+    def sort_key(item): # Helper for sorting numerically
+        try: return int(item[0])
+        except ValueError: return float('inf')
+
+    sorted_fetched_items = sorted(all_fetched_routes.items(), key=sort_key)
+
+    # Single pass: a train that runs the reverse of an earlier kept, still-unpaired train is skipped
+    for train_num, route in sorted_fetched_items:
+        start, end = route[0], route[-1]
+        waiting = unpaired_by_endpoints.get((end, start))
+        if waiting:
+            print(f"  Identified pair: Keeping {waiting.pop(0)}, will skip {train_num}")
+            continue
+
+        train_station_routes_final[train_num] = route
+        unpaired_by_endpoints.setdefault((start, end), []).append(train_num)
+
+    # Prepare table data for template
+    train_table_data = []
+    for train_num, route in train_station_routes_final.items():
+        info = all_train_infos.get(train_num, {})
+        train_table_data.append({
+            'number': info.get('number', train_num),
+            'name': info.get('name', ''),
+            'start_code': info.get('start_code', route[0] if route else ''),
+            'start_name': info.get('start_name', ''),
+            'end_code': info.get('end_code', route[-1] if route else ''),
+            'end_name': info.get('end_name', ''),
+        })
+
+    final_route_count = len(train_station_routes_final)
+    print(f"Filtered down to {final_route_count} unique direction routes.")
+
+    if not train_station_routes_final:
+         status_message = f"Found {total_trains_found} trains for {searched_station}"
+         if limit_applied: status_message += f" (processed {total_trains_to_process} due to limit)"
+         status_message += f", fetched {fetched_route_count} routes, but no unique direction routes remained after filtering."
+         return {'status_message': status_message, 'searched_station': searched_station}
+
+    # Update status before map generation
+    status_message = f"Successfully fetched {fetched_route_count} routes for {station_display}."
+    if limit_applied:
+        status_message += f" (processed {total_trains_to_process} due to limit)"
+    if timed_out_count:
+        status_message += f" ({timed_out_count} trains timed out)"
+    status_message += f". Plotting {final_route_count} unique direction routes. Generating map..."
+
+    # 3. Generate Map (using filtered routes)
+    try:
+        map_id = map_cache_key(searched_station, map_theme, train_station_routes_final)
+        try:
+            os.utime(map_file_path(map_id))  # Mark it in use, so the janitor's age/LRU pruning keeps it
+            print(f"Reusing rendered map for {searched_station} ({final_route_count} routes).")
+        except FileNotFoundError:  # Not rendered yet, or just pruned by a janitor
+            folium_map = generate_map(
+                searched_station, station_index, station_data_df, train_station_routes_final, theme=map_theme
+            )
+            save_map_file(map_id, folium_map)
+
+        # Cache the generated map and train data. Results missing timed-out trains are stored as
+        # already stale, so they are shown but refreshed on the next search
+        scrape_cache.set(
+            results_cache_key(searched_station, map_theme),
+            {'map_id': map_id, 'station_display': station_display, 'train_table_data': train_table_data,
+             'fetched_at': 0 if timed_out_count else time.time()},
+            expire=RESULTS_STALE_TTL,
+        )
+        cached_map = map_id
+        cached_train_data = train_table_data
+        cached_station_code = searched_station
+
+    except Exception as e:
+        print(f"Error during map generation: {e}")
+        error_message = "An error occurred while generating the map (potentially too much data)."
+        return {'error_message': error_message, 'status_message': status_message, 'searched_station': searched_station}
+
+    return {
+        'map_id': map_id,
+        'status_message': status_message,
+        'searched_station': searched_station,
+        'station_display': station_display,
+        'train_table_data': train_table_data,
+    }
+
+def job_is_lost(state):
+    """Checks whether a job's state says it is running but its worker has stopped updating it.
+
+    A job still queued behind busy JOB_EXECUTOR workers is never lost; if its worker dies before
+    starting it, its state simply expires after JOB_TTL.
+    """
+    return state['started'] and not state['done'] and time.time() - state['updated'] > JOB_STALL_TIMEOUT
+
+def update_job_state(job_id, **changes):
+    """Merges changes into a job's shared state. Only the thread running the job writes to it."""
+    state = scrape_cache.get(job_state_key(job_id))
+    if state is not None:
+        state.update(changes, updated=time.time())
+        scrape_cache.set(job_state_key(job_id), state, expire=JOB_TTL)
+
+def start_station_job(searched_station, station_name, map_theme, station_index, station_data_df):
+    """Starts (or joins an already running, on any worker) background search for a station and returns its job id."""
+    with jobs_lock:
+        for old_id in [jid for jid, future in jobs.items() if future.done()]:
+            del jobs[old_id]
+
+    # One transaction, so two workers can't both find no running job and each start one
+    with scrape_cache.transact():
+        running_id = scrape_cache.get(running_job_key(searched_station, map_theme))
+        state = scrape_cache.get(job_state_key(running_id)) if running_id else None
+        if state is not None and not state['done'] and not job_is_lost(state):
+            return running_id  # Same search already in flight: share it instead of scraping twice
+
+        job_id = uuid.uuid4().hex
+        scrape_cache.set(job_state_key(job_id), {
+            'station': searched_station, 'processed': 0, 'total': None,
+            'started': False, 'done': False, 'context': None, 'updated': time.time(),
+        }, expire=JOB_TTL)
+        scrape_cache.set(running_job_key(searched_station, map_theme), job_id, expire=JOB_TTL)
+
+    future = JOB_EXECUTOR.submit(
+        run_station_job, job_id, searched_station, station_name, map_theme, station_index, station_data_df
+    )
+    with jobs_lock:
+        jobs[job_id] = future
+    return job_id
+
+def run_station_job(job_id, searched_station, station_name, map_theme, station_index, station_data_df):
+    """Runs a background search, publishing its progress and finally its results to the job's state."""
+    update_job_state(job_id, started=True)  # Stall time counts from here, not from when it was queued
+    last_update = 0.0
+
+    def report_progress(processed, total):
+        nonlocal last_update
+        now = time.monotonic()
+        if processed == 0 or processed == total or now - last_update >= JOB_PROGRESS_INTERVAL:
+            last_update = now
+            update_job_state(job_id, processed=processed, total=total)
+
+    try:
+        context = build_station_results(
+            searched_station, station_name, map_theme, station_index, station_data_df, report_progress
+        )
+    except Exception as e:
+        print(f"Error in background search for {searched_station}: {e}")
+        context = {'error_message': "An unexpected error occurred while processing this station.",
+                   'searched_station': searched_station}
+    update_job_state(job_id, done=True, context=context)
+    with scrape_cache.transact():
+        if scrape_cache.get(running_job_key(searched_station, map_theme)) == job_id:
+            scrape_cache.delete(running_job_key(searched_station, map_theme))
+
+def wait_for_job(job_id):
+    """Blocks until a job has finished, whichever worker is running it."""
+    with jobs_lock:
+        future = jobs.get(job_id)
+    if future is not None:
+        future.result()
+        return
+    while True:
+        state = scrape_cache.get(job_state_key(job_id))
+        if state is None or state['done'] or job_is_lost(state):
+            return
+        time.sleep(JOB_POLL_INTERVAL)
+
+def render_results(context):
+    """Renders index.html for a finished search's template context."""
+    map_id = context.get('map_id')
+    return render_template(
+        'index.html',
+        map_url=url_for('static', filename=f'maps/{map_id}.html') if map_id else None,
+        status_message=context.get('status_message'),
+        error_message=context.get('error_message'),
+        searched_station=context.get('searched_station'),
+        station_display=context.get('station_display'),
+        train_table_data=context.get('train_table_data', []),
+    )
+
+def write_feedback_lines(lines):
+    """Appends feedback lines to FEEDBACK_FILE in one write and fsyncs it."""
+    try:
+        with open(FEEDBACK_FILE, 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        print(f"Error writing feedback to {FEEDBACK_FILE}: {e}")
+
+def drain_feedback_queue(block=True):
+    """Takes everything currently queued (waiting for the first line if block) and writes it as one batch."""
+    batch = []
+    try:
+        batch.append(feedback_queue.get(block=block))
+        while True:
+            batch.append(feedback_queue.get_nowait())
+    except queue.Empty:
+        pass
+    if batch:
+        write_feedback_lines(batch)
+
+def feedback_writer():
+    while True:
+        drain_feedback_queue()
+
+threading.Thread(target=feedback_writer, name='feedback-writer', daemon=True).start()
+atexit.register(drain_feedback_queue, block=False)
+
+def record_station_search(station_code, theme):
+    """Queues a search to be counted towards the popular stations the cache warmer keeps fresh."""
+    station_search_queue.put_nowait((station_code, theme))
+
+def write_station_searches(searches):
+    """Adds a batch of searches to the shared, decaying popularity counts in scrape_cache."""
+    now = time.time()
+    with scrape_cache.transact():  # Read-modify-write shared with the other worker processes
+        stored = scrape_cache.get(POPULAR_STATIONS_KEY)
+        if not isinstance(stored, dict) or 'counts' not in stored:
+            stored = {'counts': {}, 'updated': now}  # First use (or the old, undecayed format)
+        decay = 0.5 ** ((now - stored['updated']) / POPULAR_HALF_LIFE)
+        counts = {key: count * decay for key, count in stored['counts'].items()}
+        for key in searches:
+            counts[key] = counts.get(key, 0) + 1
+        if len(counts) > POPULAR_STATIONS_LIMIT:
+            counts = dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)[:POPULAR_STATIONS_LIMIT])
+        scrape_cache.set(POPULAR_STATIONS_KEY, {'counts': counts, 'updated': now})
+
+def station_search_counter():
+    while True:
+        searches = [station_search_queue.get()]
+        try:
+            while True:
+                searches.append(station_search_queue.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            write_station_searches(searches)
+        except Exception as e:
+            print(f"Error counting station searches: {e}")
+
+threading.Thread(target=station_search_counter, name='station-search-counter', daemon=True).start()
+
+def warm_popular_stations():
+    """Rebuilds, one at a time, the most searched stations' results that would go stale before the next pass."""
+    stored = scrape_cache.get(POPULAR_STATIONS_KEY)
+    counts = stored['counts'] if isinstance(stored, dict) and 'counts' in stored else {}
+    popular = sorted(counts, key=counts.get, reverse=True)[:WARM_STATIONS_COUNT]
+    if not popular:
+        return
+    station_index, station_data_df = load_station_coordinates(EXCEL_FILE_PATH)
+    if station_index is None:
+        return
+
+    for station_code, theme in popular:
+        cached_results = scrape_cache.get(results_cache_key(station_code, theme))
+        if (cached_results is not None and os.path.exists(map_file_path(cached_results['map_id']))
+                and time.time() - cached_results.get('fetched_at', 0) < RESULTS_CACHE_TTL - WARMER_INTERVAL):
+            continue  # Still fresh at the next pass (possibly warmed by another worker already)
+        print(f"Cache warmer: refreshing {station_code} ({theme})")
+        station_name = get_station_name(station_code, station_index, station_data_df)
+        job_id = start_station_job(station_code, station_name, theme, station_index, station_data_df)
+        wait_for_job(job_id)  # Sequential, so the warmer never holds more than one job slot
+
+def cache_warmer():
+    time.sleep(WARMER_START_DELAY)
+    while True:
+        try:
+            warm_popular_stations()
+        except Exception as e:
+            print(f"Cache warmer error: {e}")
+        time.sleep(WARMER_INTERVAL)
+
+# Loaded at import, so no worker's first request pays for it; a failed load is retried on the next request
+load_station_coordinates(EXCEL_FILE_PATH)
+
+threading.Thread(target=cache_warmer, name='cache-warmer', daemon=True).start()
+threading.Thread(target=map_janitor, name='map-janitor', daemon=True).start()
+
 # --- Flask Routes ---
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    global cached_map, cached_train_data, cached_station_code
-
-    map_html = None
-    status_message = None
-    error_message = None
     searched_station = None
-    train_table_data = []
     map_theme = 'CartoDB positron'  # Default theme
 
-    station_coordinates, station_data_df = load_station_coordinates(EXCEL_FILE_PATH)
-    if station_coordinates is None:
+    station_index, station_data_df = load_station_coordinates(EXCEL_FILE_PATH)
+    if station_index is None:
         return render_template('index.html', error_message="FATAL ERROR: Could not load station coordinates file. Check server logs.")
 
     # --- If POST, use submitted station code and theme ---
@@ -276,199 +1204,78 @@ def index():
         station_code = request.form.get('station_code', '').strip().upper()
         map_theme = request.form.get('map_theme', 'CartoDB positron')
         searched_station = station_code
-
-        # Clear the cached map if the theme is changed
-        if map_theme != session.get('map_theme', 'CartoDB positron'):
-            clear_cache()
-
-        session['last_station_code'] = station_code
-        session['map_theme'] = map_theme
     # --- If GET, but session has last station, use it ---
     elif session.get('last_station_code'):
         searched_station = session.get('last_station_code')
         map_theme = session.get('map_theme', 'CartoDB positron')
 
-    # Extract station name from station_data_df
-    station_name = None
-    if station_data_df is not None and not station_data_df.empty:
-        station_row = station_data_df[station_data_df['STN CODE'] == searched_station]
-        if not station_row.empty:
-            station_name = station_row.iloc[0, 1]  # Assuming the second column contains the station name
-
-    # Check if the map and train data are already cached
-    if searched_station == cached_station_code and map_theme == session.get('map_theme', 'CartoDB positron'):
-        print(f"Using cached data for station: {searched_station}")
-        map_html = cached_map
-        train_table_data = cached_train_data
-        station_display = f"{searched_station}: {station_name}" if station_name else searched_station
-        status_message = f"Showing cached map and data for {station_display}."
-    else:
-        # Clear the cache if a new station is searched
-        clear_cache()
-
-        if searched_station:
-            print(f"Request received for station: {searched_station}")
-
-            # 1. Fetch Train Numbers
-            train_numbers = get_trains_for_station(searched_station)
-
-            if train_numbers is None:
-                error_message = f"Error fetching train list for {searched_station}. Website might be down or unreachable."
-                return render_template('index.html', error_message=error_message, searched_station=searched_station)
-            elif not train_numbers:
-                station_display = f"{searched_station}: {station_name}" if station_name else searched_station
-                status_message = f"No trains found passing through {station_display} according to etrain.info."
-                return render_template('index.html', status_message=status_message, searched_station=searched_station)
-
-            total_trains_found = len(train_numbers)
-
-            # --- Apply Plot Limit ---
-            trains_to_process_list = train_numbers
-            limit_applied = False
-            if total_trains_found > PLOT_LIMIT:
-                print(f"Limiting processing to {PLOT_LIMIT} out of {total_trains_found} trains found.")
-                trains_to_process_list = train_numbers[:PLOT_LIMIT]
-                limit_applied = True
-            total_trains_to_process = len(trains_to_process_list)
-
-            # Build initial status message
-            station_display = f"{searched_station}: {station_name}" if station_name else searched_station
-            base_status = f"Found {total_trains_found} trains for {station_display}."
-            if limit_applied:
-                base_status += f" Processing first {total_trains_to_process} (limit {PLOT_LIMIT} applied)."
-            else:
-                base_status += f" Processing {total_trains_to_process} trains."
-            status_message = base_status + f" Fetching routes (max {MAX_WORKERS} parallel)..."
-            print(f"Processing {total_trains_to_process} trains (out of {total_trains_found} found)...")
-
-            # 2. Fetch Routes Concurrently
-            all_fetched_routes = {}
-            all_train_infos = {}
-            futures_map = {}
-            processed_count = 0
-
-            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                for train_num in trains_to_process_list:
-                    future = executor.submit(get_station_codes_for_train, train_num)
-                    futures_map[future] = train_num
-
-                for future in concurrent.futures.as_completed(futures_map):
-                    original_train_num = futures_map[future]
-                    processed_count += 1
-                    try:
-                        returned_train_num, station_codes, train_info = future.result()
-                        if station_codes and len(station_codes) >= 2:
-                            all_fetched_routes[returned_train_num] = station_codes
-                            if train_info:
-                                all_train_infos[returned_train_num] = train_info
-                    except Exception as exc:
-                        print(f"Train {original_train_num} generated an exception during fetch/process: {exc}")
-
-                    if processed_count % 20 == 0 or processed_count == total_trains_to_process:
-                        print(f"    Route fetching progress: {processed_count}/{total_trains_to_process}")
-
-            fetched_route_count = len(all_fetched_routes)
-            print(f"Fetched {fetched_route_count} valid routes. Filtering reverse duplicates...")
-
-            # 2.5 Filter Reverse Duplicates
-            train_station_routes_final = {} # Holds final routes to plot
-            processed_pairs = set()
-
-            def sort_key(item): # Helper for sorting numerically
-                try: return int(item[0])
-                except ValueError: return float('inf')
-
-            sorted_fetched_items = sorted(all_fetched_routes.items(), key=sort_key)
-
-            for train_num_a, route_a in sorted_fetched_items:
-                if train_num_a in processed_pairs: continue
-
-                start_a = route_a[0]
-                end_a = route_a[-1]
-                pair_found_and_skipped = False
-
-                for train_num_b, route_b in all_fetched_routes.items(): # Compare against original fetched list
-                     if train_num_a == train_num_b or train_num_b in processed_pairs or len(route_b) < 2: continue
-                     start_b = route_b[0]
-                     end_b = route_b[-1]
-                     if start_a == end_b and end_a == start_b:
-                         print(f"  Identified pair: Keeping {train_num_a}, will skip {train_num_b}")
-                         processed_pairs.add(train_num_b)
-                         pair_found_and_skipped = True
-                         break # Found the pair for train_a
-
-                # Add train_a to the final list and mark as processed
-                train_station_routes_final[train_num_a] = route_a
-                processed_pairs.add(train_num_a)
-
-            # Prepare table data for template
-            train_table_data = []
-            for train_num, route in train_station_routes_final.items():
-                info = all_train_infos.get(train_num, {})
-                train_table_data.append({
-                    'number': info.get('number', train_num),
-                    'name': info.get('name', ''),
-                    'start_code': info.get('start_code', route[0] if route else ''),
-                    'start_name': info.get('start_name', ''),
-                    'end_code': info.get('end_code', route[-1] if route else ''),
-                    'end_name': info.get('end_name', ''),
-                })
-
-            final_route_count = len(train_station_routes_final)
-            print(f"Filtered down to {final_route_count} unique direction routes.")
-
-            if not train_station_routes_final:
-                 status_message = f"Found {total_trains_found} trains for {searched_station}"
-                 if limit_applied: status_message += f" (processed {total_trains_to_process} due to limit)"
-                 status_message += f", fetched {fetched_route_count} routes, but no unique direction routes remained after filtering."
-                 return render_template('index.html', status_message=status_message, searched_station=searched_station)
-
-            # Update status before map generation
-            station_display = f"{searched_station}: {station_name}" if station_name else searched_station
-            status_message = f"Successfully fetched {fetched_route_count} routes for {station_display}."
-            if limit_applied:
-                status_message += f" (processed {total_trains_to_process} due to limit)"
-            status_message += f". Plotting {final_route_count} unique direction routes. Generating map..."
-
-            # 3. Generate Map (using filtered routes)
-            try:
-                folium_map = generate_map(
-                    searched_station, station_coordinates, station_data_df, train_station_routes_final, theme=map_theme
-                )
-                map_html = folium_map._repr_html_()
-
-                # Cache the generated map and train data
-                cached_map = map_html
-                cached_train_data = train_table_data
-                cached_station_code = searched_station
-                session['map_theme'] = map_theme
-
-            except Exception as e:
-                print(f"Error during map generation: {e}")
-                error_message = "An error occurred while generating the map (potentially too much data)."
-                return render_template('index.html', error_message=error_message, status_message=status_message, searched_station=searched_station)
-        else:
-            # No station searched yet, just render the page
-            pass
+    if map_theme not in MAP_THEMES:
+        map_theme = MAP_THEMES[0]  # Only the form's themes, so junk values can't become cache or job keys
+    if request.method == 'POST':
+        session['last_station_code'] = searched_station
+        session['map_theme'] = map_theme
 
-    # --- Render page ---
-    return render_template(
-        'index.html',
-        map_html=map_html,
-        status_message=status_message,
-        error_message=error_message,
-        searched_station=searched_station,
-        station_display=station_display,
-        train_table_data=train_table_data
-    )
+    station_name = get_station_name(searched_station, station_index, station_data_df)
+    if request.method == 'POST' and station_name is not None:
+        record_station_search(searched_station, map_theme)  # Only real stations, not typos
+
+    # Check if this search's map and train data are already cached (by any worker)
+    # (the map file may have been pruned since, in which case it is rebuilt below)
+    cached_results = scrape_cache.get(results_cache_key(searched_station, map_theme)) if searched_station else None
+    if cached_results is not None and os.path.exists(map_file_path(cached_results['map_id'])):
+        if time.time() - cached_results.get('fetched_at', 0) < RESULTS_CACHE_TTL:
+            print(f"Using cached data for station: {searched_station}")
+            status_message = f"Showing cached map and data for {cached_results['station_display']}."
+        else:
+            # Stale: show it now and rebuild in the background, so the next visit gets fresh data
+            print(f"Using stale cached data for station: {searched_station}, refreshing in the background")
+            start_station_job(searched_station, station_name, map_theme, station_index, station_data_df)
+            status_message = (f"Showing the last map and data for {cached_results['station_display']}; "
+                              f"it is being refreshed in the background.")
+        return render_results(dict(cached_results, status_message=status_message, searched_station=searched_station))
+
+    if not searched_station:
+        # No station searched yet, just render the page
+        return render_results({})
+
+    # The search itself runs in the background; the page polls for progress and then loads the results
+    job_id = start_station_job(searched_station, station_name, map_theme, station_index, station_data_df)
+    return redirect(url_for('job_results', job_id=job_id))
+
+@app.route('/status/<job_id>')
+def job_status(job_id):
+    state = scrape_cache.get(job_state_key(job_id))
+    if state is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    # A lost job reports done, so the page moves on to /results and shows the error there
+    return jsonify({'processed': state['processed'], 'total': state['total'],
+                    'done': state['done'] or job_is_lost(state)})
+
+@app.route('/results/<job_id>')
+def job_results(job_id):
+    state = scrape_cache.get(job_state_key(job_id))
+    if state is None:
+        # Expired: search again for the session's station
+        return redirect(url_for('index'))
+    searched_station = state['station']
+    if job_is_lost(state):
+        return render_template('index.html', error_message="The search for this station was interrupted. Please try again.",
+                               searched_station=searched_station)
+    if not state['done']:
+        return render_template(
+            'index.html',
+            job_id=job_id,
+            status_message=f"Fetching train routes for {searched_station} (max {MAX_WORKERS} parallel)...",
+            searched_station=searched_station,
+        )
+    return render_results(state['context'])
 
 @app.route('/submit_feedback', methods=['POST'])
 def submit_feedback():
     feedback = request.form.get('feedback', '').strip()
     if feedback:
-        feedback_file = os.path.join(BASE_DIR, 'feedback.txt')
-        with open(feedback_file, 'a', encoding='utf-8') as f:
-            f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {feedback}\n")
+        # Written by the feedback-writer thread; the timestamp is taken now, at submission
+        feedback_queue.put_nowait(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {feedback}\n")
         flash("Thank you for your feedback!", "success")
     else:
         flash("Feedback cannot be empty.", "error")
@@ -482,11 +1289,11 @@ def switch_map_theme():
 
     if cached_station_code and cached_map:
         # Regenerate the map with the selected theme
-        station_coordinates, station_data_df = load_station_coordinates(EXCEL_FILE_PATH)
+        station_index, station_data_df = load_station_coordinates(EXCEL_FILE_PATH)
         folium_map = generate_map(
-            cached_station_code, station_coordinates, station_data_df, cached_train_data, theme=theme
+            cached_station_code, station_index, station_data_df, cached_train_data, theme=theme
         )
-        return folium_map._repr_html_()
+        return folium_map.get_root().render()
     else:
         return "No map data available. Please search for a station first."
 
@@ -495,6 +1302,5 @@ def switch_map_theme():
 # The block below is mainly for local development testing.
 if __name__ == '__main__':
     print("Starting Flask development server for local testing...")
-    load_station_coordinates(EXCEL_FILE_PATH) # Pre-load cache locally
     # Use debug=True ONLY for local development
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))